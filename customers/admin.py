@@ -1,8 +1,21 @@
 from django.contrib import admin
-from .models import CustomUser,Configurations
+from .models import CustomUser,Configurations,MailboxCursor,Suppression,DeliveryEvent
 
 admin.site.register(CustomUser)
 
 @admin.register(Configurations)
 class ConfigurationsAdmin(admin.ModelAdmin):
-    list_display = ("user", "email", "is_active","_app_password")
\ No newline at end of file
+    list_display = ("user", "email", "is_active","_app_password")
+
+@admin.register(MailboxCursor)
+class MailboxCursorAdmin(admin.ModelAdmin):
+    list_display = ("configuration", "uidvalidity", "last_uid", "updated_at")
+
+@admin.register(Suppression)
+class SuppressionAdmin(admin.ModelAdmin):
+    list_display = ("user", "email", "reason", "created_at")
+
+@admin.register(DeliveryEvent)
+class DeliveryEventAdmin(admin.ModelAdmin):
+    list_display = ("configuration", "event_type", "recipient", "status", "received_at")
+    list_filter = ("event_type",)
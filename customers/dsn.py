@@ -0,0 +1,132 @@
+import re
+from dataclasses import dataclass
+from email.utils import parseaddr
+
+MSG_ID_RE = re.compile(r"<([^<>\s]+)>")
+AUTO_PRECEDENCE = {"auto_reply", "bulk", "junk", "list"}
+
+BOUNCE = "bounce"
+DELAY = "delay"
+REPLY = "reply"
+
+
+@dataclass
+class InboundEvent:
+    event_type: str
+    recipient: str
+    status: str = ""
+    diagnostic: str = ""
+    message_id: str = ""
+
+    @property
+    def is_hard_bounce(self):
+        return self.event_type == BOUNCE and self.status.startswith("5")
+
+
+def _address(value):
+    """Strip the address-type prefix from a DSN recipient field ("rfc822; a@b.c")"""
+    if not value:
+        return ""
+    _, _, address = str(value).rpartition(";")
+    return address.strip().strip("<>").lower()
+
+
+def _original_message_id(report):
+    for part in report.walk():
+        if part.get_content_type() == "text/rfc822-headers":
+            for line in part.get_payload(decode=True).decode(errors="replace").splitlines():
+                name, _, value = line.partition(":")
+                if name.strip().lower() == "message-id":
+                    return value.strip()
+        if part.get_content_type() == "message/rfc822":
+            original = part.get_payload(0)
+            return str(original.get("Message-ID", "")).strip()
+    return ""
+
+
+def _diagnostic(value):
+    """Drop the diagnostic-type prefix ("smtp; 550 ...") from a Diagnostic-Code"""
+    if not value:
+        return ""
+    kind, sep, text = str(value).partition(";")
+    return " ".join((text if sep else kind).split())
+
+
+def parse_dsn(message):
+    """Return one InboundEvent per failed or delayed recipient of a delivery report"""
+    events = []
+    message_id = _original_message_id(message)
+    for part in message.walk():
+        if part.get_content_type() != "message/delivery-status":
+            continue
+        # First block holds per-message fields, the rest are per-recipient
+        for block in part.get_payload()[1:]:
+            action = str(block.get("Action", "")).strip().lower()
+            if action == "failed":
+                event_type = BOUNCE
+            elif action == "delayed":
+                event_type = DELAY
+            else:
+                continue
+            recipient = _address(block.get("Final-Recipient") or block.get("Original-Recipient"))
+            if not recipient:
+                continue
+            events.append(InboundEvent(
+                event_type=event_type,
+                recipient=recipient,
+                status=str(block.get("Status", "")).strip()[:16],
+                diagnostic=_diagnostic(block.get("Diagnostic-Code")),
+                message_id=message_id[:255],
+            ))
+    return events
+
+
+def _is_automatic(message):
+    """Out-of-office and other machine-sent mail (RFC 3834 plus common vendor headers)"""
+    auto_submitted = str(message.get("Auto-Submitted", "no")).strip().lower()
+    if auto_submitted != "no":
+        return True
+    if message.get("X-Autoreply") or message.get("X-Autorespond"):
+        return True
+    return str(message.get("Precedence", "")).strip().lower() in AUTO_PRECEDENCE
+
+
+def _sendify_reference(message, message_id_domain):
+    """First In-Reply-To/References id that Sendify generated, or "" if none"""
+    suffix = "@" + message_id_domain.lower()
+    for header in ("In-Reply-To", "References"):
+        for msg_id in MSG_ID_RE.findall(str(message.get(header, ""))):
+            if msg_id.lower().endswith(suffix):
+                return f"<{msg_id}>"
+    return ""
+
+
+def is_delivery_report(message):
+    """True for DSNs; works on headers alone, so callers can skip other bodies"""
+    return (
+        message.get_content_type() == "multipart/report"
+        and str(message.get_param("report-type", "")).lower() == "delivery-status"
+    )
+
+
+def classify(message, message_id_domain):
+    """
+    Turn an inbound message into delivery events: bounces, delays or a reply.
+
+    Replies are recognised from headers alone. Only replies to mail Sendify sent (Message-ID under ``message_id_domain``)
+    count; personal threads and auto-replies in the same inbox are ignored.
+    """
+    if is_delivery_report(message):
+        return parse_dsn(message)
+    if message.get_content_type() == "multipart/report":
+        return []
+
+    if _is_automatic(message):
+        return []
+    reference = _sendify_reference(message, message_id_domain)
+    if not reference:
+        return []
+    _, sender = parseaddr(str(message.get("From", "")))
+    if not sender:
+        return []
+    return [InboundEvent(event_type=REPLY, recipient=sender.lower(), message_id=reference[:255])]
@@ -0,0 +1,212 @@
+import asyncio
+import re
+import ssl
+from functools import cache
+from email.parser import BytesFeedParser
+from email.policy import default as default_policy
+
+LITERAL_RE = re.compile(rb"\{(\d+)\}\r\n$")
+UID_RE = re.compile(rb"\bUID (\d+)")
+STATUS_CODE_RE = re.compile(rb"\[(UIDVALIDITY|UIDNEXT) (\d+)\]")
+EXISTS_RE = re.compile(rb"^\* \d+ EXISTS")
+
+CHUNK_SIZE = 64 * 1024
+
+
+class IMAPError(Exception):
+    pass
+
+
+@cache
+def default_ssl_context():
+    """Shared across connections; building one reloads the CA store"""
+    return ssl.create_default_context()
+
+
+def quote(value):
+    """Quote a string argument for an IMAP command"""
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+class IMAPClient:
+    """Minimal asyncio IMAP4rev1 client: just enough to poll an inbox with IDLE"""
+
+    def __init__(self, host, port, use_ssl=True, timeout=30):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self._tag = 0
+        self._idling = False
+
+    async def connect(self):
+        ssl_context = default_ssl_context() if self.use_ssl else None
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=ssl_context),
+            self.timeout,
+        )
+        greeting = await self._readline()
+        if not greeting.startswith(b"* OK"):
+            raise IMAPError(f"Unexpected greeting: {greeting!r}")
+
+    async def close(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (OSError, ssl.SSLError):
+            pass
+        self.writer = None
+
+    async def logout(self):
+        if self.writer is None:
+            return
+        if self._idling:
+            # Interrupted mid-IDLE; the server won't answer LOGOUT until DONE
+            await self.close()
+            return
+        try:
+            await self._command("LOGOUT")
+        except (IMAPError, OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            await self.close()
+
+    async def login(self, username, password):
+        await self._command(f"LOGIN {quote(username)} {quote(password)}")
+
+    async def select(self, mailbox="INBOX"):
+        """Select a mailbox read-only and return (uidvalidity, uidnext)"""
+        codes = {}
+        for line in await self._command(f"EXAMINE {quote(mailbox)}"):
+            for name, value in STATUS_CODE_RE.findall(line):
+                codes[name] = int(value)
+        if b"UIDVALIDITY" not in codes:
+            raise IMAPError("Server did not report UIDVALIDITY")
+        return codes[b"UIDVALIDITY"], codes.get(b"UIDNEXT", 1)
+
+    async def fetch_headers_since(self, uid):
+        """Yield (uid, headers) for every message with a UID >= ``uid``"""
+        async for item in self._fetch(f"{uid}:*", "HEADER"):
+            yield item
+
+    async def fetch_message(self, uid):
+        """Return the full message with this UID, or None if it has gone"""
+        messages = [message async for _, message in self._fetch(str(uid), "")]
+        return messages[0] if messages else None
+
+    async def _fetch(self, uids, section):
+        """
+        Yield (uid, message) from ``UID FETCH uids (UID BODY.PEEK[section])``.
+
+        The literal is fed to the parser in chunks as it arrives, but the
+        parsed message is whole in memory, so only fetch bodies you need.
+        """
+        tag = await self._send(f"UID FETCH {uids} (UID BODY.PEEK[{section}])")
+        while True:
+            line = await self._readline()
+            if line.startswith(tag + b" "):
+                self._check(line)
+                return
+            literal = LITERAL_RE.search(line)
+            if not literal:
+                continue
+            message = await self._read_message(int(literal.group(1)))
+            trailer = await self._readline()
+            found = UID_RE.search(line) or UID_RE.search(trailer)
+            if found:
+                yield int(found.group(1)), message
+
+    async def idle(self, timeout, wake=()):
+        """
+        Wait in IDLE until the server reports new mail; return True if it did.
+
+        Also stops early once any asyncio.Event in ``wake`` is set.
+        """
+        tag = await self._send("IDLE")
+        has_new = False
+        while True:
+            # Untagged updates (e.g. mail that arrived since the last FETCH) may precede "+"
+            line = await self._readline()
+            if line.startswith(b"+"):
+                break
+            if line.startswith(tag + b" "):
+                self._check(line)
+                raise IMAPError("Server ended IDLE before accepting it")
+            has_new = has_new or bool(EXISTS_RE.match(line))
+
+        self._idling = True
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not has_new and not any(event.is_set() for event in wake):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            read = asyncio.ensure_future(self.reader.readline())
+            waiters = [asyncio.ensure_future(event.wait()) for event in wake]
+            try:
+                await asyncio.wait([read, *waiters], timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for pending in (read, *waiters):
+                    pending.cancel()
+                await asyncio.gather(read, *waiters, return_exceptions=True)
+            if read.cancelled():
+                continue
+            line = read.result()
+            if not line:
+                raise IMAPError("Connection closed during IDLE")
+            has_new = bool(EXISTS_RE.match(line))
+
+        self.writer.write(b"DONE\r\n")
+        await self.writer.drain()
+        self._idling = False
+        while True:
+            line = await self._readline()
+            if line.startswith(tag + b" "):
+                self._check(line)
+                return has_new
+
+    async def _read_message(self, size):
+        parser = BytesFeedParser(policy=default_policy)
+        while size:
+            chunk = await asyncio.wait_for(
+                self.reader.read(min(size, CHUNK_SIZE)), self.timeout
+            )
+            if not chunk:
+                raise IMAPError("Connection closed mid-message")
+            parser.feed(chunk)
+            size -= len(chunk)
+        return parser.close()
+
+    async def _send(self, command):
+        self._tag += 1
+        tag = f"A{self._tag:04d}".encode()
+        self.writer.write(tag + b" " + command.encode() + b"\r\n")
+        await self.writer.drain()
+        return tag
+
+    async def _command(self, command):
+        """Run a command and return its untagged response lines"""
+        tag = await self._send(command)
+        untagged = []
+        while True:
+            line = await self._readline()
+            if line.startswith(tag + b" "):
+                self._check(line)
+                return untagged
+            untagged.append(line)
+
+    async def _readline(self):
+        line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+        if not line:
+            raise IMAPError("Connection closed by server")
+        return line
+
+    @staticmethod
+    def _check(line):
+        status = line.split(b" ", 2)[1:2]
+        if status != [b"OK"]:
+            raise IMAPError(line.decode(errors="replace").strip())
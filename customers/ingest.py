@@ -0,0 +1,358 @@
+import asyncio
+import logging
+import random
+from collections import namedtuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .dsn import classify, is_delivery_report
+from .imap import IMAPClient, IMAPError
+from .models import Configurations, DeliveryEvent, MailboxCursor, Suppression
+
+logger = logging.getLogger(__name__)
+
+
+class MailboxPool:
+    """
+    Caps the number of open IMAP connections.
+
+    A mailbox holds its slot for as long as it likes while the pool has room.
+    Once others are queued it IDLEs for at most IMAP_IDLE_TURN seconds and then
+    gives the slot up, so the pool rotates through mailboxes instead of
+    reconnecting them back to back. ``contention`` is set while anyone is
+    queued, so holders already deep in a long IDLE notice new waiters.
+    """
+
+    def __init__(self, size):
+        self._semaphore = asyncio.Semaphore(size)
+        self.waiting = 0
+        self.contention = asyncio.Event()
+
+    @property
+    def contended(self):
+        return self.waiting > 0
+
+    async def acquire(self):
+        if not self._semaphore.locked():
+            await self._semaphore.acquire()
+            return
+        self.waiting += 1
+        self.contention.set()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+            if not self.waiting:
+                self.contention.clear()
+
+    def release(self):
+        self._semaphore.release()
+
+
+class Pending(namedtuple("Pending", "worker generation uidvalidity uid event")):
+    """One queued write: a delivery event, or a cursor move when ``event`` is None"""
+
+
+class BatchWriter:
+    """
+    Collects events and cursor moves from every mailbox and writes them in bulk.
+
+    A cursor move reaches the database only in the same batch as its events
+    or a later one. If a batch fails, each mailbox in it rewinds to its last
+    committed UID, and any cursor moves it queued earlier are dropped, so the
+    lost UIDs are fetched again. A failed batch is retried one mailbox at a
+    time so a bad row only rewinds its own mailbox.
+    """
+
+    def __init__(self, batch_size, flush_interval):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue()
+
+    def add(self, worker, uid, events):
+        for event in events:
+            self.queue.put_nowait(Pending(worker, worker.generation, worker.uidvalidity, uid, event))
+
+    def advance(self, worker, last_uid):
+        self.queue.put_nowait(Pending(worker, worker.generation, worker.uidvalidity, last_uid, None))
+
+    async def run(self):
+        while True:
+            await self.drain()
+
+    async def drain(self):
+        """Wait for the first item, then gather more for up to flush_interval"""
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        await self.flush(batch)
+
+    async def flush(self, batch):
+        # Cursor moves queued before a rewind could skip events that were never written
+        batch = [
+            item for item in batch
+            if item.event is not None or item.generation == item.worker.generation
+        ]
+        try:
+            await sync_to_async(write_batch)(batch)
+        except Exception:
+            logger.warning("Failed to write %d inbound items, retrying per mailbox", len(batch))
+            await self.flush_per_worker(batch)
+            return
+        self.committed(batch)
+
+    async def flush_per_worker(self, batch):
+        """Isolate a bad row so it only rewinds the mailbox it came from"""
+        by_worker = {}
+        for item in batch:
+            by_worker.setdefault(item.worker, []).append(item)
+        for worker, items in by_worker.items():
+            try:
+                await sync_to_async(write_batch)(items)
+            except Exception:
+                logger.exception(
+                    "Failed to write %d inbound items for %s", len(items), worker.configuration.email
+                )
+                worker.rewind()
+            else:
+                self.committed(items)
+
+    @staticmethod
+    def committed(items):
+        for item in items:
+            if item.event is None:
+                item.worker.committed(item.uidvalidity, item.uid)
+
+    async def close(self):
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        if batch:
+            await self.flush(batch)
+
+
+def write_batch(batch):
+    """Persist events, suppressions and cursors from one batch in a single transaction"""
+    events = []
+    suppressions = {}
+    cursors = {}
+    close_old_connections()
+    for item in batch:
+        configuration = item.worker.configuration
+        if item.event is None:
+            cursors[configuration.pk] = MailboxCursor(
+                configuration_id=configuration.pk, uidvalidity=item.uidvalidity, last_uid=item.uid
+            )
+            continue
+        event = item.event
+        events.append(DeliveryEvent(
+            configuration_id=configuration.pk,
+            event_type=event.event_type,
+            recipient=event.recipient,
+            status=event.status,
+            diagnostic=event.diagnostic,
+            message_id=event.message_id,
+            uidvalidity=item.uidvalidity,
+            uid=item.uid,
+        ))
+        if event.is_hard_bounce:
+            key = (configuration.user_id, event.recipient)
+            suppressions[key] = Suppression(user_id=configuration.user_id, email=event.recipient)
+
+    with transaction.atomic():
+        DeliveryEvent.objects.bulk_create(events, ignore_conflicts=True)
+        Suppression.objects.bulk_create(list(suppressions.values()), ignore_conflicts=True)
+        MailboxCursor.objects.bulk_create(
+            list(cursors.values()),
+            update_conflicts=True,
+            unique_fields=["configuration"],
+            update_fields=["uidvalidity", "last_uid", "updated_at"],
+        )
+
+
+class MailboxWorker:
+    """Keeps one IDLE connection open for a configuration and ingests new mail"""
+
+    def __init__(self, configuration, pool, writer):
+        self.configuration = configuration
+        self.pool = pool
+        self.writer = writer
+        self.uidvalidity = None
+        # Highest UID handed to the writer, and highest UID known to be saved
+        self.last_uid = None
+        self.committed_uid = None
+        self.generation = 0
+        # Set by rewind() to pull the session out of IDLE and fetch again
+        self.refetch = asyncio.Event()
+
+    def client(self):
+        return IMAPClient(
+            settings.IMAP_HOST,
+            settings.IMAP_PORT,
+            use_ssl=settings.IMAP_USE_SSL,
+            timeout=settings.IMAP_TIMEOUT,
+        )
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        failures = 0
+        while True:
+            await self.pool.acquire()
+            started = loop.time()
+            try:
+                await self.session()
+                failures = 0
+            except (IMAPError, OSError, asyncio.TimeoutError) as e:
+                failures += 1
+                logger.warning("IMAP session for %s failed: %s", self.configuration.email, e)
+            finally:
+                self.pool.release()
+            if failures:
+                # Back off so a bad mailbox doesn't hog a pool slot
+                delay = min(settings.IMAP_MAX_BACKOFF, 2 ** failures)
+                delay += random.uniform(0, delay / 2)
+            else:
+                delay = 0
+            # Never log in to the same mailbox more often than the provider tolerates
+            delay = max(delay, started + settings.IMAP_MIN_RECONNECT_INTERVAL - loop.time())
+            await asyncio.sleep(delay)
+
+    async def session(self):
+        loop = asyncio.get_running_loop()
+        client = self.client()
+        try:
+            await client.connect()
+            await client.login(self.configuration.email, self.configuration.app_password)
+            uidvalidity, uidnext = await client.select()
+            await self.load_cursor(uidvalidity, uidnext)
+            turn_ends = loop.time() + settings.IMAP_IDLE_TURN
+            while True:
+                await self.fetch_new(client)
+                if self.pool.contended:
+                    timeout = turn_ends - loop.time()
+                    if timeout <= 0:
+                        return
+                    await client.idle(min(timeout, settings.IMAP_IDLE_TIMEOUT), wake=[self.refetch])
+                else:
+                    # Cut the IDLE short if someone starts waiting for a slot
+                    await client.idle(
+                        settings.IMAP_IDLE_TIMEOUT, wake=[self.pool.contention, self.refetch]
+                    )
+        finally:
+            await client.logout()
+
+    async def load_cursor(self, uidvalidity, uidnext):
+        """Resume from the saved high-water mark, or start from now on a new/reset mailbox"""
+        if self.uidvalidity is None:
+            cursor = await MailboxCursor.objects.filter(configuration=self.configuration).afirst()
+            if cursor is not None:
+                self.uidvalidity = cursor.uidvalidity
+                self.last_uid = self.committed_uid = cursor.last_uid
+        if self.uidvalidity != uidvalidity:
+            self.uidvalidity = uidvalidity
+            self.last_uid = self.committed_uid = uidnext - 1
+            self.writer.advance(self, self.last_uid)
+
+    async def fetch_new(self, client):
+        self.refetch.clear()
+        generation = self.generation
+        last_uid = self.last_uid
+        reports = []
+        # Headers are enough for replies; only delivery reports need their body
+        async for uid, headers in client.fetch_headers_since(last_uid + 1):
+            # "n:*" always matches the newest message, even if it is below n
+            if uid <= last_uid:
+                continue
+            if is_delivery_report(headers):
+                reports.append(uid)
+            else:
+                self.writer.add(self, uid, self.classify(uid, headers))
+            last_uid = max(last_uid, uid)
+        for uid in reports:
+            message = await client.fetch_message(uid)
+            if message is not None:
+                self.writer.add(self, uid, self.classify(uid, message))
+        if generation != self.generation:
+            # A write failed while we were fetching; rewind() already reset last_uid
+            return
+        if last_uid != self.last_uid:
+            self.last_uid = last_uid
+            self.writer.advance(self, last_uid)
+
+    def classify(self, uid, message):
+        try:
+            return classify(message, settings.MESSAGE_ID_DOMAIN)
+        except Exception:
+            # A malformed message must not wedge the cursor; skip it and move on
+            logger.exception("Could not classify UID %d in %s", uid, self.configuration.email)
+            return []
+
+    def committed(self, uidvalidity, uid):
+        if uidvalidity == self.uidvalidity:
+            self.committed_uid = max(self.committed_uid, uid)
+
+    def rewind(self):
+        """Forget everything past the last saved UID so it is fetched again"""
+        self.generation += 1
+        self.last_uid = self.committed_uid
+        self.refetch.set()
+
+
+class Supervisor:
+    """Runs a MailboxWorker for every active configuration and tracks changes to them"""
+
+    def __init__(self, max_connections=None):
+        self.pool = MailboxPool(max_connections or settings.IMAP_MAX_CONNECTIONS)
+        self.writer = BatchWriter(settings.IMAP_BATCH_SIZE, settings.IMAP_FLUSH_INTERVAL)
+        self.workers = {}
+
+    async def run(self):
+        writer_task = asyncio.create_task(self.writer.run())
+        try:
+            while True:
+                await self.refresh()
+                await asyncio.sleep(settings.IMAP_REFRESH_INTERVAL)
+        finally:
+            tasks = [task for _, task in self.workers.values()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            writer_task.cancel()
+            await asyncio.gather(writer_task, return_exceptions=True)
+            await self.writer.close()
+
+    async def refresh(self):
+        configurations = {
+            config.pk: config
+            async for config in Configurations.objects.filter(is_active=True)
+        }
+        for pk in set(self.workers) - set(configurations):
+            self.workers.pop(pk)[1].cancel()
+        for pk, config in configurations.items():
+            if pk in self.workers:
+                current, task = self.workers[pk]
+                if task.done() and not task.cancelled() and task.exception():
+                    logger.error("Worker for %s died", config.email, exc_info=task.exception())
+                elif not task.done() and credentials(current) == credentials(config):
+                    continue
+                task.cancel()
+            worker = MailboxWorker(config, self.pool, self.writer)
+            self.workers[pk] = (config, asyncio.create_task(worker.run()))
+        logger.info("Watching %d mailboxes", len(self.workers))
+
+
+def credentials(configuration):
+    return configuration.email, bytes(configuration._app_password)
@@ -0,0 +1,44 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from customers.ingest import Supervisor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Descriptors kept free for the database, logging and stdio
+FD_HEADROOM = 64
+
+
+def connection_limit(requested):
+    """Cap the pool below the soft open-file limit so sessions don't fail with EMFILE"""
+    if resource is None:
+        return requested
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return requested
+    return max(1, min(requested, soft - FD_HEADROOM))
+
+
+class Command(BaseCommand):
+    help = "Watch every active configuration's inbox over IMAP IDLE and record bounces and replies"
+
+    def handle(self, *args, **options):
+        max_connections = connection_limit(settings.IMAP_MAX_CONNECTIONS)
+        if max_connections < settings.IMAP_MAX_CONNECTIONS:
+            self.stderr.write(
+                f"IMAP_MAX_CONNECTIONS={settings.IMAP_MAX_CONNECTIONS} exceeds the open-file "
+                f"limit; using {max_connections} (raise it with `ulimit -n`)"
+            )
+        self.stdout.write(
+            f"Ingesting from {settings.IMAP_HOST}:{settings.IMAP_PORT} "
+            f"with up to {max_connections} connections"
+        )
+        try:
+            asyncio.run(Supervisor(max_connections).run())
+        except KeyboardInterrupt:
+            self.stdout.write("Stopped")
@@ -0,0 +1,125 @@
+# Generated by Django 5.2.5 on 2026-10-18 09:12
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("customers", "0002_configurations"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MailboxCursor",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("uidvalidity", models.PositiveBigIntegerField()),
+                ("last_uid", models.PositiveBigIntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "configuration",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="cursor",
+                        to="customers.configurations",
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="Suppression",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("email", models.EmailField(max_length=254)),
+                (
+                    "reason",
+                    models.CharField(
+                        choices=[("bounce", "Hard bounce")],
+                        default="bounce",
+                        max_length=20,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("user", "email"), name="unique_suppression_per_user"
+                    )
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="DeliveryEvent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "event_type",
+                    models.CharField(
+                        choices=[
+                            ("bounce", "Bounce"),
+                            ("delay", "Delay"),
+                            ("reply", "Reply"),
+                        ],
+                        max_length=10,
+                    ),
+                ),
+                ("recipient", models.EmailField(max_length=254)),
+                ("status", models.CharField(blank=True, max_length=16)),
+                ("diagnostic", models.TextField(blank=True)),
+                ("message_id", models.CharField(blank=True, max_length=255)),
+                ("uidvalidity", models.PositiveBigIntegerField()),
+                ("uid", models.PositiveBigIntegerField()),
+                ("received_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "configuration",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="customers.configurations",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("configuration", "uidvalidity", "uid", "recipient"),
+                        name="unique_delivery_event_per_message",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -56,3 +56,68 @@ class Configurations(models.Model):
 
     def __str__(self):
         return f"{self.email} ({'Active' if self.is_active else 'Inactive'})"
+
+
+class MailboxCursor(models.Model):
+    """Last IMAP UID ingested for a configuration's inbox"""
+    configuration = models.OneToOneField(
+        "Configurations", on_delete=models.CASCADE, related_name="cursor"
+    )
+    uidvalidity = models.PositiveBigIntegerField()
+    last_uid = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.configuration.email} @ {self.uidvalidity}:{self.last_uid}"
+
+
+class Suppression(models.Model):
+    REASON_BOUNCE = "bounce"
+    REASON_CHOICES = [
+        (REASON_BOUNCE, "Hard bounce"),
+    ]
+
+    user = models.ForeignKey("CustomUser", on_delete=models.CASCADE)
+    email = models.EmailField()
+    reason = models.CharField(max_length=20, choices=REASON_CHOICES, default=REASON_BOUNCE)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "email"], name="unique_suppression_per_user"),
+        ]
+
+    def __str__(self):
+        return f"{self.email} ({self.reason})"
+
+
+class DeliveryEvent(models.Model):
+    TYPE_BOUNCE = "bounce"
+    TYPE_DELAY = "delay"
+    TYPE_REPLY = "reply"
+    TYPE_CHOICES = [
+        (TYPE_BOUNCE, "Bounce"),
+        (TYPE_DELAY, "Delay"),
+        (TYPE_REPLY, "Reply"),
+    ]
+
+    configuration = models.ForeignKey("Configurations", on_delete=models.CASCADE)
+    event_type = models.CharField(max_length=10, choices=TYPE_CHOICES)
+    recipient = models.EmailField()
+    status = models.CharField(max_length=16, blank=True)
+    diagnostic = models.TextField(blank=True)
+    message_id = models.CharField(max_length=255, blank=True)
+    uidvalidity = models.PositiveBigIntegerField()
+    uid = models.PositiveBigIntegerField()
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["configuration", "uidvalidity", "uid", "recipient"],
+                name="unique_delivery_event_per_message",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.event_type}: {self.recipient}"
@@ -1,3 +1,462 @@
-from django.test import TestCase
+import asyncio
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from unittest.mock import patch
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.db import OperationalError
+from django.test import TestCase, override_settings
+
+from .dsn import InboundEvent, classify
+from .imap import IMAPClient, default_ssl_context
+from .ingest import BatchWriter, MailboxPool, MailboxWorker, Supervisor, write_batch
+from .management.commands.ingest_mailboxes import FD_HEADROOM, connection_limit
+from .models import Configurations, CustomUser, DeliveryEvent, MailboxCursor, Suppression
+
+BOUNCE = (
+    b"From: MAILER-DAEMON@example.com\r\n"
+    b"Subject: Undelivered Mail Returned to Sender\r\n"
+    b"MIME-Version: 1.0\r\n"
+    b'Content-Type: multipart/report; report-type=delivery-status; boundary="b"\r\n'
+    b"\r\n"
+    b"--b\r\n"
+    b"Content-Type: text/plain\r\n"
+    b"\r\n"
+    b"Delivery failed.\r\n"
+    b"--b\r\n"
+    b"Content-Type: message/delivery-status\r\n"
+    b"\r\n"
+    b"Reporting-MTA: dns; mx.example.com\r\n"
+    b"\r\n"
+    b"Final-Recipient: rfc822; Gone@Example.org\r\n"
+    b"Action: failed\r\n"
+    b"Status: 5.1.1\r\n"
+    b"Diagnostic-Code: smtp; 550 5.1.1 user unknown\r\n"
+    b"\r\n"
+    b"Final-Recipient: rfc822; slow@example.org\r\n"
+    b"Action: delayed\r\n"
+    b"Status: 4.4.1\r\n"
+    b"--b\r\n"
+    b"Content-Type: text/rfc822-headers\r\n"
+    b"\r\n"
+    b"Message-ID: <1@sendify.local>\r\n"
+    b"--b--\r\n"
+)
+
+REPLY = (
+    b"From: Bob <Bob@example.org>\r\n"
+    b"In-Reply-To: <1@sendify.local>\r\n"
+    b"Subject: Re: hello\r\n"
+    b"\r\n"
+    b"Thanks!\r\n"
+)
+
+# Forged-mail backscatter: the attached original has a Message-ID the stdlib parser chokes on
+POISON = (
+    b"From: MAILER-DAEMON@example.com\r\n"
+    b"MIME-Version: 1.0\r\n"
+    b'Content-Type: multipart/report; report-type=delivery-status; boundary="b"\r\n'
+    b"\r\n"
+    b"--b\r\n"
+    b"Content-Type: message/delivery-status\r\n"
+    b"\r\n"
+    b"Reporting-MTA: dns; mx.example.com\r\n"
+    b"\r\n"
+    b"Final-Recipient: rfc822; forged@example.org\r\n"
+    b"Action: failed\r\n"
+    b"Status: 5.1.1\r\n"
+    b"--b\r\n"
+    b"Content-Type: message/rfc822\r\n"
+    b"\r\n"
+    b"Message-ID: <<<>>@\r\n"
+    b"Subject: forged\r\n"
+    b"\r\n"
+    b"spam\r\n"
+    b"--b--\r\n"
+)
+
+PLAIN = b"From: someone@example.org\r\nSubject: hi\r\n\r\nhello\r\n"
+
+
+class IMAPStub:
+    """Tiny in-process IMAP server: LOGIN, EXAMINE, UID FETCH, IDLE and LOGOUT"""
+
+    def __init__(self, messages, uidvalidity=7, before_idle=b""):
+        self.messages = dict(messages)
+        self.uidvalidity = uidvalidity
+        self.before_idle = before_idle
+        self.fetches = []
+        self.body_fetches = []
+        self.logins = []
+        self.idles = 0
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        writer.write(b"* OK IMAP4rev1 stub ready\r\n")
+        while line := await reader.readline():
+            tag, command, *args = line.decode().strip().split(" ", 2)
+            command = command.upper()
+            if command == "LOGIN":
+                self.logins.append(args[0].split(" ")[0].strip('"'))
+            elif command == "EXAMINE":
+                uidnext = max(self.messages, default=0) + 1
+                writer.write(f"* {len(self.messages)} EXISTS\r\n".encode())
+                writer.write(f"* OK [UIDVALIDITY {self.uidvalidity}] ok\r\n".encode())
+                writer.write(f"* OK [UIDNEXT {uidnext}] ok\r\n".encode())
+            elif command == "UID":
+                uid_set = args[0].split(" ")[1]
+                section = "HEADER" if "[HEADER]" in args[0] else ""
+                if uid_set.endswith(":*"):
+                    start = int(uid_set[:-2])
+                    self.fetches.append(start)
+                    uids = [uid for uid in sorted(self.messages) if uid >= start]
+                    if not uids and self.messages:
+                        uids = [max(self.messages)]
+                else:
+                    self.body_fetches.append(int(uid_set))
+                    uids = [int(uid_set)]
+                for seq, uid in enumerate(uids, 1):
+                    body = self.messages[uid]
+                    if section:
+                        body = body[:body.index(b"\r\n\r\n") + 4]
+                    writer.write(f"* {seq} FETCH (UID {uid} BODY[{section}] {{{len(body)}}}\r\n".encode())
+                    writer.write(body + b")\r\n")
+            elif command == "IDLE":
+                self.idles += 1
+                writer.write(self.before_idle + b"+ idling\r\n")
+                await writer.drain()
+                await reader.readline()
+            elif command == "LOGOUT":
+                writer.write(b"* BYE\r\n" + tag.encode() + b" OK done\r\n")
+                await writer.drain()
+                break
+            writer.write(tag.encode() + b" OK done\r\n")
+            await writer.drain()
+        writer.close()
+
+
+def parse(raw):
+    return BytesParser(policy=default_policy).parsebytes(raw)
+
+
+async def eventually(predicate, timeout=3):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        if loop.time() > deadline:
+            raise AssertionError("condition not met in time")
+        await asyncio.sleep(0.05)
+
+
+class ClassifyTests(TestCase):
+    def test_dsn_recipients(self):
+        bounce, delay = classify(parse(BOUNCE), "sendify.local")
+        self.assertEqual(bounce.event_type, "bounce")
+        self.assertEqual(bounce.recipient, "gone@example.org")
+        self.assertEqual(bounce.status, "5.1.1")
+        self.assertEqual(bounce.diagnostic, "550 5.1.1 user unknown")
+        self.assertEqual(bounce.message_id, "<1@sendify.local>")
+        self.assertTrue(bounce.is_hard_bounce)
+        self.assertEqual(delay.event_type, "delay")
+        self.assertFalse(delay.is_hard_bounce)
+
+    def test_reply_and_plain(self):
+        (reply,) = classify(parse(REPLY), "sendify.local")
+        self.assertEqual(reply.event_type, "reply")
+        self.assertEqual(reply.recipient, "bob@example.org")
+        self.assertEqual(reply.message_id, "<1@sendify.local>")
+        self.assertEqual(classify(parse(PLAIN), "sendify.local"), [])
+
+    def test_reply_matched_through_references(self):
+        raw = REPLY.replace(
+            b"In-Reply-To: <1@sendify.local>",
+            b"In-Reply-To: <9@gmail.com>\r\nReferences: <1@sendify.local> <9@gmail.com>",
+        )
+        (reply,) = classify(parse(raw), "sendify.local")
+        self.assertEqual(reply.message_id, "<1@sendify.local>")
+
+    def test_ignores_personal_threads_and_auto_replies(self):
+        personal = REPLY.replace(b"<1@sendify.local>", b"<9@gmail.com>")
+        self.assertEqual(classify(parse(personal), "sendify.local"), [])
+        out_of_office = b"Auto-Submitted: auto-replied\r\n" + REPLY
+        self.assertEqual(classify(parse(out_of_office), "sendify.local"), [])
+        vacation = b"X-Autoreply: yes\r\n" + REPLY
+        self.assertEqual(classify(parse(vacation), "sendify.local"), [])
+
+
+class IMAPClientTests(TestCase):
+    def test_ssl_context_is_shared(self):
+        self.assertIs(default_ssl_context(), default_ssl_context())
+
+    async def test_idle_handles_untagged_before_continuation(self):
+        stub = IMAPStub({1: PLAIN}, before_idle=b"* 2 EXISTS\r\n* 1 RECENT\r\n")
+        port = await stub.start()
+        client = IMAPClient("127.0.0.1", port, use_ssl=False, timeout=5)
+        try:
+            await client.connect()
+            await client.login("owner@sendify.dev", "app-password")
+            await client.select()
+            self.assertTrue(await client.idle(timeout=5))
+            await client.logout()
+        finally:
+            await stub.stop()
+
+    async def test_idle_times_out_without_new_mail(self):
+        stub = IMAPStub({1: PLAIN})
+        port = await stub.start()
+        client = IMAPClient("127.0.0.1", port, use_ssl=False, timeout=5)
+        try:
+            await client.connect()
+            await client.login("owner@sendify.dev", "app-password")
+            await client.select()
+            self.assertFalse(await client.idle(timeout=0.1))
+            await client.logout()
+        finally:
+            await stub.stop()
+
+
+@override_settings(IMAP_HOST="127.0.0.1", IMAP_USE_SSL=False, IMAP_TIMEOUT=5)
+class MailboxWorkerTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email="owner@sendify.dev", name="Owner", password="x")
+        self.config = Configurations(user=self.user, email="owner@sendify.dev")
+        self.config.app_password = "app-password"
+        self.config.save()
+
+    async def sync(self, stub):
+        port = await stub.start()
+        writer = BatchWriter(batch_size=100, flush_interval=0)
+        worker = MailboxWorker(self.config, MailboxPool(1), writer)
+        client = IMAPClient("127.0.0.1", port, use_ssl=False, timeout=5)
+        try:
+            await client.connect()
+            await client.login(self.config.email, self.config.app_password)
+            await worker.load_cursor(*await client.select())
+            await worker.fetch_new(client)
+            await client.logout()
+        finally:
+            await stub.stop()
+        await writer.close()
+
+    async def test_starts_at_high_water_mark(self):
+        await self.sync(IMAPStub({1: BOUNCE, 2: REPLY}))
+        self.assertEqual(await DeliveryEvent.objects.acount(), 0)
+        cursor = await MailboxCursor.objects.aget(configuration=self.config)
+        self.assertEqual((cursor.uidvalidity, cursor.last_uid), (7, 2))
+
+    async def test_ingests_new_uids_once(self):
+        await MailboxCursor.objects.acreate(configuration=self.config, uidvalidity=7, last_uid=1)
+        stub = IMAPStub({1: PLAIN, 2: BOUNCE, 3: REPLY})
+        await self.sync(stub)
+        await self.sync(stub)
+
+        self.assertEqual(stub.fetches, [2, 4])
+        # Only the delivery report is downloaded in full
+        self.assertEqual(stub.body_fetches, [2])
+        events = {e.recipient: e async for e in DeliveryEvent.objects.all()}
+        self.assertEqual(set(events), {"gone@example.org", "slow@example.org", "bob@example.org"})
+        self.assertEqual(events["bob@example.org"].uid, 3)
+        self.assertEqual(
+            [s.email async for s in Suppression.objects.filter(user=self.user)],
+            ["gone@example.org"],
+        )
+        cursor = await MailboxCursor.objects.aget(configuration=self.config)
+        self.assertEqual(cursor.last_uid, 3)
+
+    async def test_uidvalidity_change_resets_cursor(self):
+        await MailboxCursor.objects.acreate(configuration=self.config, uidvalidity=6, last_uid=50)
+        await self.sync(IMAPStub({1: BOUNCE}))
+        self.assertEqual(await DeliveryEvent.objects.acount(), 0)
+        cursor = await MailboxCursor.objects.aget(configuration=self.config)
+        self.assertEqual((cursor.uidvalidity, cursor.last_uid), (7, 1))
+
+    async def test_malformed_message_is_skipped(self):
+        await MailboxCursor.objects.acreate(configuration=self.config, uidvalidity=7, last_uid=1)
+        with self.assertLogs("customers.ingest", "ERROR") as logs:
+            await self.sync(IMAPStub({1: PLAIN, 2: BOUNCE, 3: POISON, 4: REPLY}))
+
+        self.assertIn("UID 3", logs.output[0])
+        self.assertEqual(
+            {e.recipient async for e in DeliveryEvent.objects.all()},
+            {"gone@example.org", "slow@example.org", "bob@example.org"},
+        )
+        cursor = await MailboxCursor.objects.aget(configuration=self.config)
+        self.assertEqual(cursor.last_uid, 4)
+
+    async def test_failed_write_does_not_move_cursor(self):
+        await MailboxCursor.objects.acreate(configuration=self.config, uidvalidity=7, last_uid=1)
+        stub = IMAPStub({1: PLAIN, 2: BOUNCE, 3: REPLY})
+        port = await stub.start()
+        writer = BatchWriter(batch_size=2, flush_interval=0)
+        worker = MailboxWorker(self.config, MailboxPool(1), writer)
+        client = IMAPClient("127.0.0.1", port, use_ssl=False, timeout=5)
+        try:
+            await client.connect()
+            await client.login(self.config.email, self.config.app_password)
+            await worker.load_cursor(*await client.select())
+            await worker.fetch_new(client)
+
+            # The first batch (both UID 2 events) fails; the rest still flush
+            locked = OperationalError("database is locked")
+            with patch("customers.ingest.write_batch", side_effect=locked):
+                with self.assertLogs("customers.ingest", "ERROR"):
+                    await writer.drain()
+            await writer.close()
+            cursor = await MailboxCursor.objects.aget(configuration=self.config)
+            self.assertEqual(cursor.last_uid, 1)
+            self.assertEqual(worker.last_uid, 1)
+
+            await worker.fetch_new(client)
+            await writer.close()
+            await client.logout()
+        finally:
+            await stub.stop()
+
+        self.assertEqual(stub.fetches, [2, 2])
+        self.assertEqual(await DeliveryEvent.objects.acount(), 3)
+        self.assertTrue(await Suppression.objects.filter(email="gone@example.org").aexists())
+        cursor = await MailboxCursor.objects.aget(configuration=self.config)
+        self.assertEqual(cursor.last_uid, 3)
+
+    async def test_failed_batch_only_rewinds_the_bad_mailbox(self):
+        other = Configurations(user=self.user, email="other@sendify.dev", is_active=False)
+        other.app_password = "app-password"
+        await sync_to_async(other.save)()
+        writer = BatchWriter(batch_size=100, flush_interval=0)
+        good = MailboxWorker(other, MailboxPool(1), writer)
+        bad = MailboxWorker(self.config, MailboxPool(1), writer)
+        for worker in (good, bad):
+            worker.uidvalidity, worker.last_uid, worker.committed_uid = 7, 2, 1
+            event = InboundEvent(event_type="bounce", recipient="gone@example.org", status="5.1.1")
+            writer.add(worker, 2, [event])
+            writer.advance(worker, 2)
+
+        def fail_for_bad_rows(items):
+            if any(item.worker is bad for item in items):
+                raise OperationalError("FOREIGN KEY constraint failed")
+            write_batch(items)
+
+        with patch("customers.ingest.write_batch", side_effect=fail_for_bad_rows):
+            with self.assertLogs("customers.ingest", "WARNING"):
+                await writer.close()
+
+        cursor = await MailboxCursor.objects.aget(configuration=other)
+        self.assertEqual(cursor.last_uid, 2)
+        self.assertEqual(good.committed_uid, 2)
+        self.assertFalse(good.refetch.is_set())
+        self.assertFalse(await MailboxCursor.objects.filter(configuration=self.config).aexists())
+        self.assertEqual(bad.last_uid, 1)
+        self.assertTrue(bad.refetch.is_set())
+
+    async def test_rewind_wakes_idle_to_refetch(self):
+        stub = IMAPStub({1: PLAIN})
+        port = await stub.start()
+        writer = BatchWriter(batch_size=100, flush_interval=0)
+        worker = MailboxWorker(self.config, MailboxPool(1), writer)
+        with self.settings(IMAP_PORT=port, IMAP_IDLE_TIMEOUT=60):
+            task = asyncio.create_task(worker.run())
+            try:
+                await eventually(lambda: stub.idles == 1)
+                worker.rewind()
+                await eventually(lambda: len(stub.fetches) == 2)
+            finally:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await stub.stop()
+
+    async def test_full_pool_rotates_without_login_storm(self):
+        configs = [self.config]
+        for i in range(2):
+            config = Configurations(user=self.user, email=f"extra{i}@sendify.dev", is_active=False)
+            config.app_password = "app-password"
+            await sync_to_async(config.save)()
+            configs.append(config)
+        stub = IMAPStub({1: PLAIN})
+        port = await stub.start()
+        pool = MailboxPool(2)
+        writer = BatchWriter(batch_size=100, flush_interval=0)
+        with self.settings(IMAP_PORT=port, IMAP_IDLE_TURN=0.3, IMAP_MIN_RECONNECT_INTERVAL=0.5):
+            tasks = [asyncio.create_task(MailboxWorker(c, pool, writer).run()) for c in configs]
+            await asyncio.sleep(2)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        await stub.stop()
+
+        # Every mailbox got a turn, and none reconnected faster than the minimum interval
+        self.assertEqual(set(stub.logins), {c.email for c in configs})
+        for config in configs:
+            self.assertLessEqual(stub.logins.count(config.email), 5)
+        # Slot holders IDLE for their turn instead of logging out straight away
+        self.assertLessEqual(len(stub.logins), 2 * 2 / 0.3 + 2)
+
+
+    async def test_late_waiter_cuts_long_idle_short(self):
+        other = Configurations(user=self.user, email="late@sendify.dev", is_active=False)
+        other.app_password = "app-password"
+        await sync_to_async(other.save)()
+        stub = IMAPStub({1: PLAIN})
+        port = await stub.start()
+        pool = MailboxPool(1)
+        writer = BatchWriter(batch_size=100, flush_interval=0)
+        with self.settings(IMAP_PORT=port, IMAP_IDLE_TIMEOUT=60, IMAP_IDLE_TURN=0.2):
+            holder = asyncio.create_task(MailboxWorker(self.config, pool, writer).run())
+            tasks = [holder]
+            try:
+                await eventually(lambda: stub.idles == 1)
+                # Arrives while the holder is in a 60s IDLE with nobody queued
+                tasks.append(asyncio.create_task(MailboxWorker(other, pool, writer).run()))
+                await eventually(lambda: other.email in stub.logins)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                await stub.stop()
+
+class SupervisorTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email="owner@sendify.dev", name="Owner", password="x")
+        self.config = Configurations(user=self.user, email="owner@sendify.dev")
+        self.config.app_password = "app-password"
+        self.config.save()
+
+    async def test_refresh_follows_configuration_changes(self):
+        supervisor = Supervisor()
+        with patch.object(MailboxWorker, "run", lambda self: asyncio.sleep(3600)):
+            await supervisor.refresh()
+            _, first = supervisor.workers[self.config.pk]
+            await supervisor.refresh()
+            self.assertIs(supervisor.workers[self.config.pk][1], first)
+
+            # New credentials restart the worker
+            self.config.app_password = "rotated"
+            await sync_to_async(self.config.save)()
+            await supervisor.refresh()
+            _, second = supervisor.workers[self.config.pk]
+            self.assertIsNot(second, first)
+            await asyncio.gather(first, return_exceptions=True)
+            self.assertTrue(first.cancelled())
+
+            # Deactivating stops it
+            self.config.is_active = False
+            await sync_to_async(self.config.save)()
+            await supervisor.refresh()
+            self.assertEqual(supervisor.workers, {})
+            await asyncio.gather(second, return_exceptions=True)
+            self.assertTrue(second.cancelled())
+
+
+
+class IngestCommandTests(TestCase):
+    def test_connection_limit_stays_under_open_file_limit(self):
+        with patch("resource.getrlimit", return_value=(1024, 4096)):
+            self.assertEqual(connection_limit(2000), 1024 - FD_HEADROOM)
+            self.assertEqual(connection_limit(100), 100)
@@ -57,6 +57,25 @@ SIMPLE_JWT = {
 
 ENCRYPTION_KEY = config("ENCRYPTION_KEY")
 
+# Domain for Message-IDs on mail Sendify sends (email.utils.make_msgid(domain=...));
+# inbound mail only counts as a reply if it references one of these
+MESSAGE_ID_DOMAIN = config("MESSAGE_ID_DOMAIN", default="sendify.local")
+
+# Inbound bounce/reply ingestion (python manage.py ingest_mailboxes)
+IMAP_HOST = config("IMAP_HOST", default="imap.gmail.com")
+IMAP_PORT = config("IMAP_PORT", default=993, cast=int)
+IMAP_USE_SSL = config("IMAP_USE_SSL", default=True, cast=bool)
+IMAP_TIMEOUT = config("IMAP_TIMEOUT", default=30, cast=int)
+IMAP_IDLE_TIMEOUT = config("IMAP_IDLE_TIMEOUT", default=29 * 60, cast=int)  # RFC 2177: re-issue before 30 min
+# Each connection is a file descriptor; ingest_mailboxes clamps this to RLIMIT_NOFILE
+IMAP_MAX_CONNECTIONS = config("IMAP_MAX_CONNECTIONS", default=900, cast=int)
+IMAP_IDLE_TURN = config("IMAP_IDLE_TURN", default=300, cast=int)  # slot time per mailbox when the pool is full
+IMAP_MIN_RECONNECT_INTERVAL = config("IMAP_MIN_RECONNECT_INTERVAL", default=60, cast=int)
+IMAP_MAX_BACKOFF = config("IMAP_MAX_BACKOFF", default=300, cast=int)
+IMAP_BATCH_SIZE = config("IMAP_BATCH_SIZE", default=500, cast=int)
+IMAP_FLUSH_INTERVAL = config("IMAP_FLUSH_INTERVAL", default=2.0, cast=float)
+IMAP_REFRESH_INTERVAL = config("IMAP_REFRESH_INTERVAL", default=60, cast=int)
+
 ROOT_URLCONF = "sendify.urls"
 AUTH_USER_MODEL = "customers.CustomUser"
 